@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
+import asyncio
+import csv
 import json
 import os
+import queue
 import shlex
-import subprocess
+import signal
+import threading
 import time
+from collections import deque
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
+from typing import Deque, List, Optional, Tuple
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, request, redirect, url_for, jsonify
 
 BASE_DIR = Path(__file__).resolve().parent
 REPO_DIR = BASE_DIR.parent
@@ -20,11 +25,25 @@ UPDATE_SCRIPT = BASE_DIR / "update_all.sh"
 SERVICE_NAME = os.environ.get("WILDLIFE_SERVICE", "rpi-cam-server")
 SSH_IDENTITY = os.environ.get("WILDLIFE_SSH_KEY", "")  # e.g. /home/julianflowers/.ssh/id_ed25519_hub
 
+# OpenSSH ControlMaster sockets: one persistent connection per camera, reused by later commands.
+# Only an optimisation: if the directory can't be created (no/read-only HOME), use plain ssh.
+SSH_CONTROL_DIR: Optional[Path]
+try:
+    SSH_CONTROL_DIR = Path(os.environ.get("WILDLIFE_SSH_CONTROL_DIR") or Path.home() / ".ssh" / "cm")
+    SSH_CONTROL_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+except (OSError, RuntimeError):
+    SSH_CONTROL_DIR = None
+
 # Dashboard bind (defaults: listen on LAN; set to 127.0.0.1 if you only want local)
 BIND_HOST = os.environ.get("WILDLIFE_BIND", "0.0.0.0")
 BIND_PORT = int(os.environ.get("WILDLIFE_PORT", "5050"))
 
+# Lines of stdout/stderr kept per command; older output is dropped as it streams in
+OUTPUT_TAIL_LINES = 200
+
 app = Flask(__name__)
+# Compiled once; each request only renders it with the dynamic context
+_INDEX_TEMPLATE = app.jinja_env.get_template("index.html")
 
 @dataclass
 class Camera:
@@ -32,20 +51,27 @@ class Camera:
     ssh: str
     preview_base: Optional[str] = None  # e.g. http://192.168.68.73:8000
 
-def _load_cameras() -> List[Camera]:
-    cams: List[Camera] = []
-    if not CAMERA_FILE.exists():
-        return cams
+# (st_mtime_ns, cameras) of the last parse of CAMERA_FILE
+_CAM_CACHE: Optional[Tuple[int, List[Camera]]] = None
 
-    for line in CAMERA_FILE.read_text().splitlines():
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
+def _load_cameras() -> List[Camera]:
+    global _CAM_CACHE
+    try:
+        st = CAMERA_FILE.stat()
+    except FileNotFoundError:
+        return []
+    cached = _CAM_CACHE
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        return cached[1]
 
+    cams: List[Camera] = []
+    for row in csv.reader(CAMERA_FILE.read_text().splitlines(), skipinitialspace=True):
         # Allow:
         #  - "name, user@host, http://host:port"
         #  - "user@host"
-        parts = [p.strip() for p in line.split(",")]
+        parts = [p.strip() for p in row]
+        if not parts or not parts[0] or parts[0].startswith("#"):
+            continue
 
         if len(parts) == 1:
             ssh = parts[0]
@@ -56,50 +82,122 @@ def _load_cameras() -> List[Camera]:
             ssh = parts[1]
             preview = parts[2] if len(parts) >= 3 and parts[2] else None
             cams.append(Camera(name=name, ssh=ssh, preview_base=preview))
+
+    _CAM_CACHE = (st.st_mtime_ns, cams)
     return cams
 
-def _run(cmd: List[str], timeout: int = 120) -> dict:
-    """Run a command and capture stdout/stderr."""
+async def _drain(stream: asyncio.StreamReader, tail: Deque[bytes]) -> None:
+    """Read a pipe line by line as the child writes, keeping only the last lines."""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            continue  # over-long line: asyncio discards it, keep reading
+        if not line:
+            break
+        tail.append(line)
+
+def _tail_text(tail: Deque[bytes], limit: int = 12000) -> str:
+    """Decode only the capped tail of the kept output, not everything the child wrote."""
+    return b"".join(tail)[-limit:].decode("utf-8", errors="replace")
+
+async def _run_async(cmd: List[str], timeout: int = 120) -> dict:
+    """Run a command without blocking the event loop and capture stdout/stderr."""
     started = time.time()
+    out: Deque[bytes] = deque(maxlen=OUTPUT_TAIL_LINES)
+    err: Deque[bytes] = deque(maxlen=OUTPUT_TAIL_LINES)
+    p = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=str(REPO_DIR),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,  # own process group, so a timeout can kill grandchildren too
+    )
+    timed_out = False
     try:
-        p = subprocess.run(
-            cmd,
-            cwd=str(REPO_DIR),
-            capture_output=True,
-            text=True,
-            timeout=timeout,
+        await asyncio.wait_for(
+            asyncio.gather(_drain(p.stdout, out), _drain(p.stderr, err), p.wait()),
+            timeout,
         )
-        return {
-            "ok": p.returncode == 0,
-            "returncode": p.returncode,
-            "stdout": p.stdout[-12000:],  # cap output
-            "stderr": p.stderr[-12000:],
-            "seconds": round(time.time() - started, 2),
-            "cmd": " ".join(shlex.quote(c) for c in cmd),
-        }
-    except subprocess.TimeoutExpired as e:
-        return {
-            "ok": False,
-            "returncode": None,
-            "stdout": (e.stdout or "")[-12000:],
-            "stderr": (e.stderr or "Timed out")[-12000:],
-            "seconds": round(time.time() - started, 2),
-            "cmd": " ".join(shlex.quote(c) for c in cmd),
-        }
+    except asyncio.TimeoutError:
+        timed_out = True
+        # Kill the whole group: a surviving grandchild (e.g. update_all.sh's ssh)
+        # would otherwise hold the pipes open and p.wait() would never return.
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(p.wait(), 5)
+        except asyncio.TimeoutError:
+            pass
+
+    stderr = _tail_text(err)
+    if timed_out and not stderr:
+        stderr = "Timed out"
+    return {
+        "ok": not timed_out and p.returncode == 0,
+        "returncode": None if timed_out else p.returncode,
+        "stdout": _tail_text(out),  # capped output
+        "stderr": stderr,
+        "seconds": round(time.time() - started, 2),
+        "cmd": " ".join(shlex.quote(c) for c in cmd),
+    }
+
+async def _run_many(cmds: List[List[str]], timeout: int = 120) -> List[dict]:
+    """Run several commands concurrently; results are in the same order as cmds."""
+    return list(await asyncio.gather(*(_run_async(c, timeout) for c in cmds)))
+
+def _run(cmd: List[str], timeout: int = 120) -> dict:
+    """Run a command and capture stdout/stderr (blocking wrapper around _run_async)."""
+    return asyncio.run(_run_async(cmd, timeout))
 
 def _ssh_cmd(host: str, remote_cmd: str) -> List[str]:
     base = ["ssh", "-o", "BatchMode=yes"]
+    if SSH_CONTROL_DIR is not None:
+        base += [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPersist=600",
+            "-o", f"ControlPath={SSH_CONTROL_DIR}/%r@%h:%p",
+        ]
     if SSH_IDENTITY:
         base += ["-i", SSH_IDENTITY]
     base += [host, remote_cmd]
     return base
 
+# State is persisted by a background writer so request threads never wait on the SD card;
+# _last_state serves reads (e.g. the redirect straight after an action) until the write lands.
+_state_queue: "queue.Queue[dict]" = queue.Queue()
+_last_state: Optional[dict] = None
+
+def _state_writer() -> None:
+    while True:
+        payload = _state_queue.get()
+        # Only the newest payload matters; skip any that queued up behind it
+        while True:
+            try:
+                payload = _state_queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            STATE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = STATE_FILE.with_suffix(".tmp")
+            tmp.write_text(json.dumps(payload, separators=(",", ":")))
+            os.replace(tmp, STATE_FILE)  # atomic: readers never see a half-written file
+        except Exception:
+            pass
+
+threading.Thread(target=_state_writer, daemon=True).start()
+
 def _write_state(payload: dict) -> None:
-    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    global _last_state
     payload["ts"] = time.strftime("%Y-%m-%d %H:%M:%S %Z", time.localtime())
-    STATE_FILE.write_text(json.dumps(payload, indent=2))
+    _last_state = payload
+    _state_queue.put(payload)
 
 def _read_state() -> dict:
+    if _last_state is not None:
+        return _last_state
     if not STATE_FILE.exists():
         return {"ts": None, "last": None}
     try:
@@ -107,11 +205,14 @@ def _read_state() -> dict:
     except Exception:
         return {"ts": None, "last": None}
 
+def _restart_remote_cmd() -> str:
+    return f"sudo systemctl restart {SERVICE_NAME} && systemctl --no-pager --full status {SERVICE_NAME} | head -n 20"
+
 @app.get("/")
 def index():
     cams = _load_cameras()
     state = _read_state()
-    return render_template("index.html", cameras=cams, state=state, service=SERVICE_NAME)
+    return _INDEX_TEMPLATE.render(cameras=cams, state=state, service=SERVICE_NAME)
 
 @app.post("/update_all")
 def update_all():
@@ -127,14 +228,28 @@ def restart(name: str):
         _write_state({"action": "restart", "result": {"ok": False, "stderr": f"Unknown camera: {name}"}})
         return redirect(url_for("index"))
 
-    remote = f"sudo systemctl restart {SERVICE_NAME} && systemctl --no-pager --full status {SERVICE_NAME} | head -n 20"
-    res = _run(_ssh_cmd(cam.ssh, remote), timeout=120)
+    res = _run(_ssh_cmd(cam.ssh, _restart_remote_cmd()), timeout=120)
     _write_state({"action": f"restart:{name}", "result": res})
     return redirect(url_for("index"))
 
+@app.post("/restart_all")
+def restart_all():
+    cams = _load_cameras()
+    remote = _restart_remote_cmd()
+    # All cameras at once, each riding its ControlMaster socket: ~1 RTT total, not N
+    results = asyncio.run(_run_many([_ssh_cmd(c.ssh, remote) for c in cams], timeout=120))
+    _write_state({"action": "restart_all", "result": {c.name: r for c, r in zip(cams, results)}})
+    return redirect(url_for("index"))
+
 @app.get("/state.json")
 def state_json():
     return jsonify(_read_state())
 
 if __name__ == "__main__":
-    app.run(host=BIND_HOST, port=BIND_PORT, debug=False)
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host=BIND_HOST, port=BIND_PORT, debug=False)
+    else:
+        # Command-driven UI; a few threads so a long update_all doesn't block the page
+        serve(app, host=BIND_HOST, port=BIND_PORT, threads=4)
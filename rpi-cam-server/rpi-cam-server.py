@@ -3,11 +3,14 @@
 rpi-cam-server.py
 
 Features
-- Always-on live preview (MJPEG) at /stream.mjpg
+- Always-on live preview (MJPEG) at /stream.mjpg, JPEG-encoded once by
+  Picamera2's MJPEGEncoder (hardware on Pi Zero..4), not per client
 - Web UI at /
 - Stills from live preview (no pipeline stop) at /api/capture_still
-- Async MP4 clip recording at /api/record_clip (doesn't freeze preview)
-- Optional motion detection that triggers clips
+- Async MP4 clip recording at /api/record_clip, run as a second encoder
+  alongside the MJPEG stream (doesn't freeze preview)
+- Optional motion detection that triggers clips (MOG2 background subtraction
+  on the 320x240 lores Y plane, so no colour conversion or full-frame blur)
 - Media browser at /media/ and direct file links at /media/<filename>
 - Correct colours (uses BGR888 end-to-end for OpenCV)
 
@@ -16,9 +19,13 @@ Notes
   or use environment variable RPI_CAM_BASE_DIR=/path/to/media
 """
 
+import hashlib
+import io
 import os
+import queue
 import time
 import threading
+import traceback
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
@@ -27,31 +34,70 @@ from flask import (
     Flask,
     jsonify,
     request,
-    render_template_string,
     send_from_directory,
     Response,
 )
 
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FfmpegOutput
+from picamera2 import MappedArray, Picamera2
+from picamera2.encoders import H264Encoder, MJPEGEncoder
+from picamera2.outputs import FfmpegOutput, FileOutput
 
 import cv2
+import numpy as np
+
+# Small per-thread stacks (default is 8 MB of VM each); must precede any Thread()
+threading.stack_size(512 * 1024)
 
 # ---------------- Boot status / progress ----------------
 from threading import Event
 _boot = {"step": "starting", "percent": 0, "ready": False, "errors": []}
 _boot_ready_evt = Event()
 
+# Main stream (stills) and low-res YUV420 stream used only for motion detection (width, height)
+MAIN_SIZE = (1280, 720)
+MOTION_SIZE = (320, 240)
+
+# Changed-pixel count that counts as motion: 1500 px at 1280x720 scaled to lores (~1/12)
+MOTION_MIN_PIXELS = 125
+
+# Preallocated preview/motion frame slots, recycled round-robin
+FRAME_POOL_SIZE = 4
+
+# Each /stream.mjpg viewer holds a server worker thread for the life of the stream,
+# so cap viewers below the worker count: 6 streams + 4 threads always left for the API
+MAX_STREAM_CLIENTS = 6
+SERVER_THREADS = 10
+
+
+# ---------------- MJPEG streaming output ----------------
+
+class StreamingOutput(io.BufferedIOBase):
+    """
+    File-like sink for MJPEGEncoder: keeps only the latest JPEG frame (and its
+    sequence number) and wakes every waiting client when a new one arrives.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.seq = 0
+        self.condition = threading.Condition()
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = bytes(buf)
+            self.seq += 1
+            self.condition.notify_all()
+
 
 # ---------------- Camera Manager ----------------
 
 class CameraManager:
     """
     Handles:
-      - Always-on preview frames for MJPEG
+      - Always-on MJPEG stream (hardware encoder -> StreamingOutput)
+      - Preview frames for stills and motion detection
       - Still capture (from live preview so preview doesn't vanish)
-      - Video clips (MP4 via FfmpegOutput)
+      - Video clips (MP4 via FfmpegOutput, H264 encoder in parallel with the stream)
       - Optional motion detection that triggers clips
     """
 
@@ -69,23 +115,47 @@ class CameraManager:
         self.base_dir.mkdir(parents=True, exist_ok=True)
 
         # Locks
-        self._frame_lock = threading.Lock()    # protects _preview_frame
-        self._camera_lock = threading.Lock()   # serialises Picamera2 ops (critical)
+        self._frame_lock = threading.Lock()    # protects _preview_running
+        self._camera_lock = threading.Lock()   # serialises pipeline changes (configure/start/stop/encoders)
         self._record_lock = threading.Lock()   # protects recording state
 
         # Shared state
+        # Frames are copied straight out of the camera's DMA buffers into a fixed
+        # ring of arrays (so the preview loop never allocates) and published by
+        # reference swap, which is atomic under the GIL. A published slot is
+        # rewritten FRAME_POOL_SIZE frames later, so readers may use a snapshot
+        # without lock/copy only if they finish within a few frames (the motion
+        # loop does); slower readers such as capture_still must copy first.
         self._preview_frame = None
+        self._motion_frame = None              # lores Y plane (uint8, HxW)
+
+        mw, mh = MAIN_SIZE
+        lw, lh = MOTION_SIZE
+        self._frame_pool = [np.empty((mh, mw, 3), dtype=np.uint8) for _ in range(FRAME_POOL_SIZE)]
+        self._motion_pool = [np.empty((lh, lw), dtype=np.uint8) for _ in range(FRAME_POOL_SIZE)]
+        self._pool_idx = 0
         self._preview_running = False
+        self._stream_out = StreamingOutput()
+        # Set while the pipeline is started; frame capture waits on this instead of
+        # taking _camera_lock, so it never contends with encoder start/stop.
+        self._camera_running = threading.Event()
         self._recording = False
 
+        # One long-lived clip worker; at most one clip can be waiting behind it
+        self._clip_q = queue.Queue(maxsize=1)
+        self._clip_worker = threading.Thread(target=self._clip_consumer, daemon=True)
+        self._clip_worker.start()
+
         self._motion_enabled = False
         self._motion_thread = None
         self._motion_stop_evt = threading.Event()
 
         # Single configuration used for preview AND recording
         # IMPORTANT: BGR888 so OpenCV gets correct colours without conversion.
+        # The lores YUV420 stream gives motion detection luminance for free.
         self.video_config = self.picam2.create_video_configuration(
-            main={"size": (1280, 720), "format": "RGB888"},
+            main={"size": MAIN_SIZE, "format": "RGB888"},
+            lores={"size": MOTION_SIZE, "format": "YUV420"},
         )
         with self._camera_lock:
             self.picam2.configure(self.video_config)
@@ -102,13 +172,21 @@ class CameraManager:
             self._preview_running = True
 
         with self._camera_lock:
-            self.picam2.start()
+            self._start_stream()
 
         t = threading.Thread(target=self._preview_loop, daemon=True)
         t.start()
 
+    def _start_stream(self):
+        """Start the camera with the MJPEG encoder feeding _stream_out. Call under _camera_lock."""
+        # MJPEGEncoder is the V4L2 hardware encoder on VC4 Pis (Zero..4); on Pi 5,
+        # which has no JPEG block, picamera2 maps it to its libav encoder instead.
+        self.picam2.start_recording(MJPEGEncoder(bitrate=4_000_000), FileOutput(self._stream_out))
+        self._camera_running.set()
+
     def _restart_camera(self):
         """Robustly restart camera pipeline in the configured mode."""
+        self._camera_running.clear()
         with self._camera_lock:
             try:
                 self.picam2.stop_recording()
@@ -119,22 +197,52 @@ class CameraManager:
             except Exception:
                 pass
             self.picam2.configure(self.video_config)
-            self.picam2.start()
+            self._start_stream()
 
     def _preview_loop(self):
-        # Continuously grab frames for preview + stills + motion detection
+        # Continuously grab frames for stills + motion detection
         while True:
             with self._frame_lock:
                 if not self._preview_running:
                     break
 
+            # Don't capture while the pipeline is being stopped/reconfigured
+            if not self._camera_running.wait(timeout=0.5):
+                if not self._camera_lock.locked():
+                    # Nobody is bringing it back (e.g. a restart failed): retry
+                    try:
+                        self._restart_camera()
+                    except Exception:
+                        time.sleep(0.5)
+                continue
+
             try:
-                with self._camera_lock:
-                    frame = self.picam2.capture_array("main")
-                with self._frame_lock:
-                    self._preview_frame = frame
+                w, h = MOTION_SIZE
+                frame = self._frame_pool[self._pool_idx]
+                y = self._motion_pool[self._pool_idx]
+
+                # Picamera2 serialises request completion internally; no lock needed.
+                # The timeout matters: stop() doesn't cancel a pending capture, so a
+                # dead pipeline would otherwise park this loop here forever.
+                with self.picam2.captured_request(wait=1.0) as req:
+                    # Read-only mappings: we only copy out, and the encoders are
+                    # still reading these buffers (no CPU cache write-back either)
+                    with MappedArray(req, "main", write=False) as m:
+                        np.copyto(frame, m.array)
+                    with MappedArray(req, "lores", write=False) as m:
+                        np.copyto(y, m.array[:h, :w])  # Y plane of YUV420
+
+                self._preview_frame = frame
+                self._motion_frame = y
+                self._pool_idx = (self._pool_idx + 1) % FRAME_POOL_SIZE
             except Exception:
-                # If capture fails, restart and retry
+                # If capture fails, restart and retry. A timed-out capture leaves its
+                # job queued (stop() doesn't cancel it); drop it so it can't grab and
+                # leak a buffer from the restarted pipeline.
+                try:
+                    self.picam2.cancel_all_and_flush()
+                except Exception:
+                    pass
                 time.sleep(0.1)
                 try:
                     self._restart_camera()
@@ -142,25 +250,25 @@ class CameraManager:
                     time.sleep(0.5)
 
     def mjpeg_generator(self):
-        """Generator for Flask MJPEG endpoint."""
+        """Generator for Flask MJPEG endpoint (yields pre-encoded hardware JPEGs)."""
+        out = self._stream_out
+        last_seen = 0
         while True:
-            with self._frame_lock:
-                frame = None if self._preview_frame is None else self._preview_frame.copy()
-
-            if frame is None:
-                time.sleep(0.02)
-                continue
-
-            ok, jpeg = cv2.imencode(".jpg", frame)
-            if not ok:
-                time.sleep(0.01)
-                continue
+            # All clients share the same immutable bytes object; the timeout keeps
+            # a stalled encoder (e.g. mid-restart) from parking clients forever.
+            # No fixed frame rate: once a few frames are queued for a viewer the
+            # server blocks this yield (waitress: outbuf_high_watermark in __main__),
+            # and a client slower than the encoder then skips to the newest frame.
+            with out.condition:
+                if not out.condition.wait_for(lambda: out.seq > last_seen, timeout=1.0):
+                    continue
+                frame = out.frame
+                last_seen = out.seq
 
             yield (
                 b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n" + jpeg.tobytes() + b"\r\n"
+                b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
             )
-            time.sleep(0.03)  # ~30 fps
 
     # ---------- Stills (from preview, no pipeline stop) ----------
 
@@ -172,13 +280,14 @@ class CameraManager:
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         path = self.base_dir / f"still_{ts}.jpg"
 
-        with self._frame_lock:
-            frame = None if self._preview_frame is None else self._preview_frame.copy()
+        # Copy: the preview slot is recycled a few frames from now, and encoding
+        # the JPEG can take longer than that on a small Pi.
+        frame = None if self._preview_frame is None else self._preview_frame.copy()
 
         # Fallback: if no preview frame yet, capture directly
         if frame is None:
-            with self._camera_lock:
-                frame = self.picam2.capture_array("main")
+            # Bounded wait so a stopped pipeline errors instead of hanging the request
+            frame = self.picam2.capture_array("main", wait=1.0)
 
         cv2.imwrite(str(path), frame)
         return path
@@ -188,7 +297,8 @@ class CameraManager:
     def record_clip(self, duration: int = 30) -> Optional[Path]:
         """
         Record a clip of `duration` seconds to MP4 via ffmpeg.
-        Safe to call from a background thread. Uses camera lock to avoid preview freeze.
+        Safe to call from a background thread. The H264 encoder runs alongside the
+        MJPEG stream encoder, so live preview keeps flowing while recording.
         """
         with self._record_lock:
             if self._recording:
@@ -203,21 +313,30 @@ class CameraManager:
             encoder = H264Encoder(bitrate=10_000_000)
             output = FfmpegOutput(str(path))
 
-            # Start/stop recording under camera lock to avoid clashing with capture_array
+            # Start/stop the encoder under camera lock so it can't race a restart
+            swapped = False
             with self._camera_lock:
-                self.picam2.start_recording(encoder, output)
+                try:
+                    self.picam2.start_encoder(encoder, output)
+                except Exception:
+                    # Older picamera2 allows one encoder only: swap the stream out for the clip
+                    swapped = True
+                    self._camera_running.clear()
+                    self.picam2.stop_recording()
+                    self.picam2.start_recording(encoder, output)
+                    self._camera_running.set()
 
             time.sleep(max(1, int(duration)))
 
-            with self._camera_lock:
-                self.picam2.stop_recording()
-
-            # Optional “belt & braces”: ensure preview keeps flowing after recording
-            # (helps with some libcamera/picam2 versions)
-            try:
-                self._restart_camera()
-            except Exception:
-                pass
+            if swapped:
+                # Stops the clip recording and brings the MJPEG stream back
+                try:
+                    self._restart_camera()
+                except Exception:
+                    pass
+            else:
+                with self._camera_lock:
+                    self.picam2.stop_encoder(encoder)
 
             return path
 
@@ -231,16 +350,28 @@ class CameraManager:
             with self._record_lock:
                 self._recording = False
 
+    def _clip_consumer(self):
+        while True:
+            duration = self._clip_q.get()
+            try:
+                self.record_clip(duration)
+            except Exception:
+                # Report like a crashed thread would, but keep the worker alive
+                traceback.print_exc()
+
     def start_record_clip_async(self, duration: int = 30) -> bool:
         """
-        Starts recording in a daemon thread and returns immediately.
-        Returns False if already recording.
+        Hands the clip to the background clip worker and returns immediately.
+        Returns False if already recording or a clip is already queued.
         """
         with self._record_lock:
             if self._recording:
                 return False
 
-        threading.Thread(target=self.record_clip, args=(duration,), daemon=True).start()
+        try:
+            self._clip_q.put_nowait(duration)
+        except queue.Full:
+            return False
         return True
 
     # ---------- Motion detection ----------
@@ -257,32 +388,40 @@ class CameraManager:
         self._motion_stop_evt.set()
 
     def _motion_loop(self):
-        prev_gray = None
         cool_down_until = 0
 
+        # MOG2 keeps a per-pixel background model (copes with lighting drift) and
+        # its output is summarised with one countNonZero instead of findContours.
+        mog = cv2.createBackgroundSubtractorMOG2(history=200, varThreshold=32, detectShadows=False)
+
+        # Reused across iterations so the pipeline doesn't allocate per frame
+        w, h = MOTION_SIZE
+        gray = np.empty((h, w), dtype=np.uint8)
+        fg = np.empty((h, w), dtype=np.uint8)
+
+        tick = 0
+        warmup = 5  # let the background model settle before trusting it
+
         while not self._motion_stop_evt.is_set():
-            with self._frame_lock:
-                frame = None if self._preview_frame is None else self._preview_frame.copy()
+            y = self._motion_frame
 
-            if frame is None:
+            # Wake at 10 Hz but only run the model on every 3rd wake-up
+            tick += 1
+            if y is None or tick % 3:
                 time.sleep(0.1)
                 continue
 
-            # frame is BGR (correct for OpenCV)
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
+            # y is already luminance at lores size, so a small kernel suffices
+            cv2.GaussianBlur(y, (9, 9), 0, dst=gray)
+            # Apply on every pass so the background model keeps tracking lighting drift
+            mog.apply(gray, fg)
 
-            if prev_gray is None:
-                prev_gray = gray
+            if warmup:
+                warmup -= 1
                 time.sleep(0.1)
                 continue
 
-            diff = cv2.absdiff(prev_gray, gray)
-            thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=2)
-            contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            motion_detected = any(cv2.contourArea(c) > 1500 for c in contours)
+            motion_detected = cv2.countNonZero(fg) > MOTION_MIN_PIXELS
 
             now = time.time()
             if motion_detected and now > cool_down_until:
@@ -290,7 +429,6 @@ class CameraManager:
                 self.start_record_clip_async(30)
                 cool_down_until = now + 40  # seconds cooldown
 
-            prev_gray = gray
             time.sleep(0.1)
 
 
@@ -401,18 +539,34 @@ INDEX_HTML = """
 """
 
 
+# The UI page is static (no template variables), so encode it once at import
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_INDEX_ETAG = hashlib.blake2b(_INDEX_BYTES, digest_size=8).hexdigest()
+
+
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML)
+    resp = Response(_INDEX_BYTES, mimetype="text/html")
+    resp.set_etag(_INDEX_ETAG)
+    return resp.make_conditional(request)
+
+
+_stream_slots = threading.BoundedSemaphore(MAX_STREAM_CLIENTS)
 
 
 @app.route("/stream.mjpg")
 def stream_mjpeg():
-    return Response(
+    if not _stream_slots.acquire(blocking=False):
+        return Response("Too many stream viewers", status=503, headers={"Retry-After": "10"})
+
+    resp = Response(
         camera.mjpeg_generator(),
         mimetype="multipart/x-mixed-replace; boundary=frame",
         headers={"Cache-Control": "no-cache, no-store, must-revalidate"},
     )
+    # The server closes the response when the viewer disconnects
+    resp.call_on_close(_stream_slots.release)
+    return resp
 
 
 @app.route("/api/capture_still", methods=["POST"])
@@ -450,24 +604,55 @@ def api_motion():
         return jsonify({"status": "ok", "motion": "off"})
 
 
+# Rendered /media/ listing, keyed on the media dir's st_mtime_ns
+_media_index_cache = {}
+_MEDIA_EXTS = {"jpg", "jpeg", "png", "gif", "mp4", "h264"}
+
+
+def _stat_etag(st: os.stat_result) -> str:
+    return hashlib.blake2b(f"{st.st_mtime_ns}:{st.st_size}".encode(), digest_size=8).hexdigest()
+
+
 @app.route("/media/<path:filename>")
 def media_file(filename):
-    return send_from_directory(camera.base_dir, filename)
+    # conditional=True: Werkzeug answers If-None-Match / If-Modified-Since / Range
+    # using its mtime+size ETag, so repeat fetches of a clip are cheap 304s.
+    resp = send_from_directory(camera.base_dir, filename, conditional=True)
+    # The body is the open file wrapped by the server's wsgi.file_wrapper (waitress
+    # provides one); pass it straight through rather than iterating it in Python.
+    resp.direct_passthrough = True
+    return resp
 
 
 @app.route("/media/")
 def media_index():
-    files = sorted(os.listdir(camera.base_dir))
-    items = []
-    for f in files:
-        if f.lower().endswith((".jpg", ".jpeg", ".png", ".gif", ".mp4", ".h264")):
-            items.append(f)
+    st = os.stat(camera.base_dir)
+    etag = _stat_etag(st)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        html = _media_index_cache.get(st.st_mtime_ns)
+        if html is None:
+            # scandir's DirEntry carries the file type from readdir, so no per-file stat
+            with os.scandir(camera.base_dir) as it:
+                items = sorted(
+                    e.name for e in it
+                    if e.is_file() and os.path.splitext(e.name)[1][1:].lower() in _MEDIA_EXTS
+                )
+
+            html = (
+                f"<h1>Media files</h1><p>Folder: <code>{camera.base_dir}</code></p><ul>"
+                + "".join(f'<li><a href="/media/{f}">{f}</a></li>' for f in items)
+                + "</ul>"
+            )
 
-    html = [f"<h1>Media files</h1><p>Folder: <code>{camera.base_dir}</code></p><ul>"]
-    for f in items:
-        html.append(f'<li><a href="/media/{f}">{f}</a></li>')
-    html.append("</ul>")
-    return "".join(html)
+            _media_index_cache.clear()
+            _media_index_cache[st.st_mtime_ns] = html
+        resp = Response(html, mimetype="text/html")
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, must-revalidate"
+    return resp
 
 
 @app.route("/api/status")
@@ -484,5 +669,25 @@ def api_status():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "8000"))
-    # threaded=True helps the MJPEG stream stay responsive while other requests run
-    app.run(host="0.0.0.0", port=port, threaded=True)
+    # _boot is already marked ready above, before the server starts accepting.
+    try:
+        from waitress import serve
+    except ImportError:
+        # threaded=True helps the MJPEG stream stay responsive while other requests run
+        app.run(host="0.0.0.0", port=port, threaded=True)
+    else:
+        # Streams are capped at MAX_STREAM_CLIENTS (see stream_mjpeg), leaving the
+        # remaining SERVER_THREADS workers free for the API and media requests.
+        serve(
+            app,
+            host="0.0.0.0",
+            port=port,
+            threads=SERVER_THREADS,
+            connection_limit=32,
+            channel_timeout=3600,
+            # Block the MJPEG yield after ~256 KiB (a few frames) queued per viewer
+            # instead of the 16 MiB default. The overflow limit leaves room for the
+            # one frame written past the watermark, so it never spills to temp files.
+            outbuf_high_watermark=256 * 1024,
+            outbuf_overflow=512 * 1024,
+        )